@@ -51,9 +51,8 @@ class SettingsUpdateRequest(BaseModel):
     actor: str = "admin"
 
 # User-specific endpoints (optimized for extensions)
-@router.get("/api/credits/user/{user_id}", tags=["credits"])
-async def get_user_credits(user_id: str, _: bool = Depends(verify_api_key)):
-    """Get specific user's credit information - optimized for extensions"""
+async def _get_or_sync_user(user_id: str):
+    """Get user's credit data, syncing the user from OpenWebUI if not known yet"""
     user_data = db.get_user_credits(user_id)
     
     if not user_data:
@@ -61,22 +60,10 @@ async def get_user_credits(user_id: str, _: bool = Depends(verify_api_key)):
         await sync_user_from_openwebui(user_id)
         user_data = db.get_user_credits(user_id)
     
-    if not user_data:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    return {
-        "id": user_data["id"],
-        "credits": user_data["balance"],
-        "groups": user_data.get("groups", []),  # New field with all groups
-        "group_name": user_data.get("group_name"),
-        "default_credits": user_data.get("default_credits", 0),
-        # For backward compatibility, include group_id as the first group's ID
-        "group_id": user_data.get("groups", [{}])[0].get("id") if user_data.get("groups") else None
-    }
+    return user_data
 
-@router.get("/api/credits/model/{model_id:path}", tags=["credits"])
-async def get_model_pricing(model_id: str, _: bool = Depends(verify_api_key)):
-    """Get specific model's pricing information - optimized for extensions"""
+def _get_or_create_model(model_id: str):
+    """Get model's pricing data, auto-creating the model with default pricing if not known yet"""
     model_data = db.get_model_pricing(model_id)
     
     if not model_data:
@@ -88,6 +75,22 @@ async def get_model_pricing(model_id: str, _: bool = Depends(verify_api_key)):
         if not model_data:  # Still None after creation - something went wrong
             raise HTTPException(status_code=500, detail="Failed to create model pricing")
     
+    return model_data
+
+def _user_response(user_data: dict) -> dict:
+    """Shape user's credit data as returned to extensions"""
+    return {
+        "id": user_data["id"],
+        "credits": user_data["balance"],
+        "groups": user_data.get("groups", []),  # New field with all groups
+        "group_name": user_data.get("group_name"),
+        "default_credits": user_data.get("default_credits", 0),
+        # For backward compatibility, include group_id as the first group's ID
+        "group_id": user_data.get("groups", [{}])[0].get("id") if user_data.get("groups") else None
+    }
+
+def _model_response(model_data: dict) -> dict:
+    """Shape model's pricing data as returned to extensions"""
     return {
         "id": model_data["id"],
         "name": model_data["name"],
@@ -96,21 +99,70 @@ async def get_model_pricing(model_id: str, _: bool = Depends(verify_api_key)):
         "is_free": model_data.get("is_free", False)
     }
 
+@router.get("/api/credits/user/{user_id}", tags=["credits"])
+async def get_user_credits(user_id: str, _: bool = Depends(verify_api_key)):
+    """Get specific user's credit information - optimized for extensions"""
+    user_data = await _get_or_sync_user(user_id)
+    
+    if not user_data:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    return _user_response(user_data)
+
+@router.get("/api/credits/model/{model_id:path}", tags=["credits"])
+async def get_model_pricing(model_id: str, _: bool = Depends(verify_api_key)):
+    """Get specific model's pricing information - optimized for extensions"""
+    return _model_response(_get_or_create_model(model_id))
+
+@router.get("/api/credits/precheck", tags=["credits"])
+async def precheck_credits(
+    user_id: str = Query(..., description="User ID"),
+    model_id: str = Query(..., description="Model ID"),
+    _: bool = Depends(verify_api_key)
+):
+    """
+    Get user's credits and model's pricing in one request - used by extensions
+    before running a prompt. "user" is null if the user is not known.
+    The parameters are not named "user"/"model" because SecurityMiddleware
+    strips "user" from query strings.
+    """
+    user_data = await _get_or_sync_user(user_id)
+    
+    return {
+        "user": _user_response(user_data) if user_data else None,
+        "model": _model_response(_get_or_create_model(model_id))
+    }
+
+@router.get("/api/credits/free-models", tags=["credits"])
+async def get_free_models(_: bool = Depends(verify_api_key)):
+    """Get IDs of all free models - lets extensions skip credit checks for them"""
+    return {
+        "models": [model["id"] for model in db.get_all_models() if model.get("is_free", False)]
+    }
+
 # Optimized credit deduction endpoint for extensions
 @router.post("/api/credits/deduct-tokens", tags=["credits"])
 async def deduct_credits_for_tokens(request: CreditDeductionRequest, _: bool = Depends(verify_api_key)):
     """
     Optimized endpoint for credit deduction based on token usage.
     Now also accepts cached_tokens and reasoning_tokens for logging.
+    Resolves the user and model the same way as the lookup endpoints and reports
+    user_exists/model_exists/is_free, so extensions need only this one request.
     """
     # Get user and model data efficiently
-    user_data = db.get_user_credits(request.user_id)
+    user_data = await _get_or_sync_user(request.user_id)
     if not user_data:
-        raise HTTPException(status_code=404, detail="User not found")
+        return {
+            "success": False,
+            "cost": 0.0,
+            "deducted": 0.0,
+            "new_balance": 0.0,
+            "is_free": False,
+            "user_exists": False,
+            "model_exists": db.get_model_pricing(request.model_id) is not None
+        }
 
-    model_data = db.get_model_pricing(request.model_id)
-    if not model_data:
-        raise HTTPException(status_code=404, detail="Model pricing not found")
+    model_data = _get_or_create_model(request.model_id)
 
     # Check if model is free
     is_free = model_data.get("is_free", False)
@@ -157,7 +209,9 @@ async def deduct_credits_for_tokens(request: CreditDeductionRequest, _: bool = D
         "completion_cost": completion_cost,
         "cached_tokens": request.cached_tokens,
         "reasoning_tokens": request.reasoning_tokens,
-        "is_free": is_free
+        "is_free": is_free,
+        "user_exists": True,
+        "model_exists": True
     }
 
 # Batch endpoint for admin UI (when you need multiple users/models)
@@ -9,12 +9,14 @@ dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(dotenv_path)
 
 import asyncio
+import queue
 import ssl
 import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Response, HTTPException, Depends, Query
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.base import BaseHTTPMiddleware
 from watchdog.observers import Observer
@@ -146,32 +148,71 @@ class SecurityMiddleware(BaseHTTPMiddleware):
 
 # File watcher for OpenWebUI database changes
 class OpenWebUIDBWatcher(FileSystemEventHandler):
+    DEBOUNCE_SECONDS = 2
+    MAX_DELAY_SECONDS = 10  # Don't postpone a sync forever under constant writes
+
     def __init__(self, loop):
-        self.last_modified = 0
         self.loop = loop  # Store reference to the main event loop
-        
+        self._events = queue.SimpleQueue()  # Paths handed over from the watcher thread
+        self._wakeup_pending = False
+        self._timer = None  # Debounce timer, only touched on the loop thread
+        self._burst_started = 0.0
+        self._sync_task = None
+
     def on_modified(self, event):
         if event.is_directory:
             return
             
         if event.src_path == DB_FILE:
-            # Debounce - only sync if more than 2 seconds since last modification
-            import time
-            current_time = time.time()
-            if current_time - self.last_modified > 2:
-                self.last_modified = current_time
-                print(f"🔄 OpenWebUI database changed, syncing users and models...")
-                # Schedule the coroutine to run in the main event loop
-                asyncio.run_coroutine_threadsafe(
-                    credits_v2.sync_all_from_openwebui(), 
-                    self.loop
-                )
+            # Runs on the watchdog thread - only wake the loop once per batch of events
+            self._events.put(event.src_path)
+            if not self._wakeup_pending:
+                self._wakeup_pending = True
+                self.loop.call_soon_threadsafe(self._maybe_fire)
+
+    def _maybe_fire(self):
+        """Drain pending events on the loop thread and (re)arm the debounce timer"""
+        self._wakeup_pending = False
+        drained = 0
+        while True:
+            try:
+                self._events.get_nowait()
+            except queue.Empty:
+                break
+            drained += 1
+        if not drained:
+            return
+
+        # Debounce - only sync once the database has been quiet for DEBOUNCE_SECONDS
+        now = self.loop.time()
+        if self._timer:
+            if now - self._burst_started >= self.MAX_DELAY_SECONDS:
+                return  # Let the pending sync fire instead of pushing it back again
+            self._timer.cancel()
+        else:
+            self._burst_started = now
+        self._timer = self.loop.call_later(self.DEBOUNCE_SECONDS, self._fire)
+
+    def _fire(self):
+        self._timer = None
+        app_logger.info("🔄 OpenWebUI database changed, syncing users and models...")
+        self._sync_task = self.loop.create_task(credits_v2.sync_all_from_openwebui())
 
 # Global observer instance
 db_observer = None
 reset_task = None  # Global background task for reset checking
 sync_task = None  # Global background task for OpenWebUI sync (PostgreSQL only)
 
+# Configure logging for application lifecycle and file watcher events
+app_logger = logging.getLogger('credit_admin')
+app_logger.setLevel(logging.INFO)
+
+# Only add handler if none exist (prevents duplicate handlers on reload)
+if not app_logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    app_logger.addHandler(handler)
+
 # Configure logging for reset operations
 reset_logger = logging.getLogger('credit_reset')
 reset_logger.setLevel(logging.INFO)
@@ -315,20 +356,20 @@ async def lifespan(app: FastAPI):
     global db_observer, reset_task, sync_task
     
     # Startup
-    print("🚀 Initializing Credit Management System v2.0...")
+    app_logger.info("🚀 Initializing Credit Management System v2.0...")
     
     # Print database configuration
     if DATABASE_URL:
-        print(f"🔗 OPENWEBUI DB: PostgreSQL ({obfuscate_db_url(DATABASE_URL)})")
+        app_logger.info(f"🔗 OPENWEBUI DB: PostgreSQL ({obfuscate_db_url(DATABASE_URL)})")
     elif DB_FILE:
-        print(f"🔗 OPENWEBUI DB: SQLite ({DB_FILE})")
+        app_logger.info(f"🔗 OPENWEBUI DB: SQLite ({DB_FILE})")
     else:
-        print("🔗 OPENWEBUI DB: Not configured")
+        app_logger.info("🔗 OPENWEBUI DB: Not configured")
     
     if is_postgresql_database():
-        print(f"💾 CREDIT ADMIN DB: PostgreSQL ({obfuscate_db_url(CREDIT_DATABASE_URL)})")
+        app_logger.info(f"💾 CREDIT ADMIN DB: PostgreSQL ({obfuscate_db_url(CREDIT_DATABASE_URL)})")
     else:
-        print("💾 CREDIT ADMIN DB: SQLite")
+        app_logger.info("💾 CREDIT ADMIN DB: SQLite")
     
     # Print security configuration
     print_security_config()
@@ -337,7 +378,7 @@ async def lifespan(app: FastAPI):
         # Migration from JSON has been removed; skip automatic migration
         users = db.get_all_users_with_credits()
         if not users:
-            print("⚠️  No users found in database.")
+            app_logger.warning("⚠️  No users found in database.")
         
         # Sync users and models from OpenWebUI
         await credits_v2.sync_all_from_openwebui()
@@ -347,17 +388,17 @@ async def lifespan(app: FastAPI):
         
         # Start periodic reset checker as background task
         reset_task = asyncio.create_task(periodic_reset_checker())
-        print("🔄 Started periodic reset checker (checks every hour)")
+        app_logger.info("🔄 Started periodic reset checker (checks every hour)")
         
         # Choose sync method based on OpenWebUI database type
         if DATABASE_URL:
             # PostgreSQL: Use periodic sync instead of file watching
-            print("🔄 Using PostgreSQL for OpenWebUI - starting periodic sync (every 5 minutes)")
+            app_logger.info("🔄 Using PostgreSQL for OpenWebUI - starting periodic sync (every 5 minutes)")
             sync_task = asyncio.create_task(periodic_openwebui_sync())
         else:
             # SQLite: Use file watching
             if os.path.exists(DB_FILE):
-                print(f"👁️  Watching OpenWebUI database: {DB_FILE}")
+                app_logger.info(f"👁️  Watching OpenWebUI database: {DB_FILE}")
                 # Get the current event loop
                 loop = asyncio.get_running_loop()
                 event_handler = OpenWebUIDBWatcher(loop)
@@ -365,20 +406,20 @@ async def lifespan(app: FastAPI):
                 db_observer.schedule(event_handler, os.path.dirname(DB_FILE), recursive=False)
                 db_observer.start()
             else:
-                print(f"⚠️  OpenWebUI database not found: {DB_FILE}")
+                app_logger.warning(f"⚠️  OpenWebUI database not found: {DB_FILE}")
         
-        print("✅ Database initialized and ready!")
+        app_logger.info("✅ Database initialized and ready!")
     except Exception as e:
-        print(f"❌ Database initialization error: {e}")
+        app_logger.error(f"❌ Database initialization error: {e}")
     
     yield  # Application runs here
     
     # Shutdown
-    print("🛑 Shutting down...")
+    app_logger.info("🛑 Shutting down...")
     
     # Cancel the reset checker task
     if reset_task:
-        print("🛑 Stopping periodic reset checker...")
+        app_logger.info("🛑 Stopping periodic reset checker...")
         reset_task.cancel()
         try:
             await reset_task
@@ -387,7 +428,7 @@ async def lifespan(app: FastAPI):
     
     # Cancel the sync task (PostgreSQL only)
     if sync_task:
-        print("🛑 Stopping periodic OpenWebUI sync...")
+        app_logger.info("🛑 Stopping periodic OpenWebUI sync...")
         sync_task.cancel()
         try:
             await sync_task
@@ -396,7 +437,7 @@ async def lifespan(app: FastAPI):
     
     # Stop database watcher
     if db_observer:
-        print("🛑 Stopping database watcher...")
+        app_logger.info("🛑 Stopping database watcher...")
         db_observer.stop()
         db_observer.join()
 
@@ -412,20 +453,36 @@ app.add_middleware(SecurityMiddleware)
 # Static files setup
 static_dir = os.path.join(os.path.dirname(__file__), "static")
 index_file = os.path.join(static_dir, "index.html")
+pricing_file = os.path.join(static_dir, "pricing.html")
+waiting_list_file = os.path.join(static_dir, "waiting_list.html")
+
+# Static pages don't change at runtime - stat each one on its first request instead
+# of on every request
+_static_stats = {}
+
+def _static_page(path: str) -> FileResponse:
+    """Serve a static page, reusing its stat result once the file has been found"""
+    stat_result = _static_stats.get(path)
+    if stat_result is None:
+        try:
+            stat_result = _static_stats[path] = os.stat(path)
+        except FileNotFoundError:
+            # Let FileResponse report the missing page for this route only
+            return FileResponse(path)
+    return FileResponse(path, stat_result=stat_result)
 
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
 @app.get("/")
 @app.head("/")
 def serve_index():
-    return FileResponse(index_file)
+    return _static_page(index_file)
 
 @app.get("/pricing")
 @app.head("/pricing")
 def serve_pricing():
     """Public pricing page - no authentication required"""
-    pricing_file = os.path.join(static_dir, "pricing.html")
-    return FileResponse(pricing_file)
+    return _static_page(pricing_file)
 
 # Include routers
 app.include_router(auth.router)
@@ -435,8 +492,7 @@ app.include_router(waiting_list.router)
 # Public waiting list registration page
 @app.get("/waiting-list")
 def serve_waiting_list():
-    waiting_file = os.path.join(static_dir, "waiting_list.html")
-    return FileResponse(waiting_file)
+    return _static_page(waiting_list_file)
 
 # CORS middleware - Tighten for production security
 # In production, replace "*" with actual allowed origins like ["https://yourdomain.com"]
@@ -448,6 +504,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger JSON responses (reset history, user/model lists). Added after CORS
+# so it wraps it and compresses the final response body exactly once.
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
 # Health check endpoint (public)
 @app.get("/health", tags=["health"])
 @app.head("/health", tags=["health"])
@@ -149,6 +149,30 @@ else
     fi
 fi
 
+# Test 6: Extension precheck query params pass the security middleware
+# (it redirects URLs carrying params such as "user", which httpx doesn't follow)
+echo -n "6. Testing precheck query params: "
+precheck_url="$API_BASE_URL/precheck?user_id=security-test&model_id=security-test"
+if [ -n "$CREDITS_API_KEY" ]; then
+    resp=$(curl "${CURLOPTS[@]}" -o /dev/null -w '%{http_code}' -H "X-API-Key: $CREDITS_API_KEY" "$precheck_url" 2>&1)
+    code=$?
+    expected="200"
+else
+    resp=$(curl "${CURLOPTS[@]}" -o /dev/null -w '%{http_code}' "$precheck_url" 2>&1)
+    code=$?
+    expected="401/403"
+fi
+if [ $code -ne 0 ]; then
+    echo -e "${RED}UNREACHABLE${NC} (curl error: ${resp})"
+else
+    status="$resp"
+    if [ "$status" = "200" ] || { [ "$expected" = "401/403" ] && { [ "$status" = "401" ] || [ "$status" = "403" ]; }; }; then
+        echo -e "${GREEN}PASS${NC} (not redirected)"
+    else
+        echo -e "${RED}FAIL${NC} (expected ${expected}, got ${status:-unknown})"
+    fi
+fi
+
 echo ""
 echo "Security Configuration Summary:"
 echo "------------------------------"
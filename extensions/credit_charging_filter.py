@@ -2,14 +2,32 @@
 title: Credit management Charging credits
 author: Miloslav Konopík, DDVVY
 version: 1.0
+requirements: orjson, httpx[http2]
 """
 
+import importlib.util
 import os
+import asyncio
+import hashlib
+from urllib.parse import quote
 from pydantic import BaseModel, Field
 import httpx
-import tiktoken
-import re
-from functools import partial
+import time
+from collections import OrderedDict
+from functools import lru_cache, partial
+
+# orjson serializes and parses the credits API payloads several times faster than
+# the standard library; fall back to json where it isn't installed
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    import json
+
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    _json_loads = json.loads
+
 
 # Translation table for i18n support
 TRANSLATIONS = {
@@ -33,23 +51,206 @@ TRANSLATIONS = {
     }
 
 }
+# Flat (language, key) -> string view of TRANSLATIONS for single-lookup translation
+_FLAT_TRANSLATIONS = {
+    (lang, key): text for lang, table in TRANSLATIONS.items() for key, text in table.items()
+}
+
+# Long texts are encoded in slices so BPE cost stays linear in the input length;
+# beyond the hard cap they are only estimated at ~4 characters per token
+CHUNK_CHARS = 25_000
+HARD_CAP_CHARS = 200_000
+# Minimum number of texts for which tiktoken's threaded batch encoder is used
+BATCH_MIN_TEXTS = 8
 
+# Token counts of recently seen texts keyed by (encoding name, blake2b digest), so
+# chat history re-sent on every turn is only encoded once. Short texts are cheaper
+# to encode than to hash and are never cached.
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_MIN_CHARS = 64
+_token_counts = OrderedDict()
 
 
+# Tokenizer module, imported on first manual count: turns whose completion reports
+# usage never load it
+_tt = None
+
+
+def _get_tokenizer():
+    """Return the tokenizer module, importing it on first use."""
+    global _tt
+    if _tt is None:
+        # riptoken is a faster drop-in for tiktoken's get_encoding/encoding_for_model
+        # API; use it when installed and fall back to tiktoken otherwise
+        try:
+            import riptoken as tokenizer
+        except ImportError:
+            import tiktoken as tokenizer
+        _tt = tokenizer
+    return _tt
+
+
+@lru_cache(maxsize=32)
+def _get_encoding(name):
+    """Return the tiktoken encoding with the given name, cached per process."""
+    return _get_tokenizer().get_encoding(name)
+
+
+@lru_cache(maxsize=128)
+def _encoding_for_model(model):
+    """Return the tiktoken encoding for a model name, or None if it is unknown."""
+    try:
+        return _get_tokenizer().encoding_for_model(model)
+    except KeyError:
+        return None
+
+
+@lru_cache(maxsize=1024)
+def _path_segment(value):
+    """Percent-encode an ID for use as a single URL path segment."""
+    return quote(str(value), safe="")
+
+
+# Shared HTTP clients, one per SSL verification setting, reused across requests
+# so connections to the credits API stay alive between chat turns. Over HTTPS they
+# negotiate HTTP/2 when the h2 package is installed, multiplexing concurrent
+# requests on one connection.
+_CLIENTS = {}
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+def _get_client(verify):
+    """Return the pooled AsyncClient for the given SSL verification setting."""
+    client = _CLIENTS.get(verify)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            verify=verify,
+            http2=_HTTP2,
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+            timeout=httpx.Timeout(10.0),
+        )
+        _CLIENTS[verify] = client
+    return client
+
+
+# Cache of user and model metadata: {kind: {id: (expires_at, data)}}, least recently
+# used first. Model pricing changes rarely and is kept for a few minutes, user data
+# only briefly. Unknown IDs (404) are cached as None for a short while so a bad ID
+# doesn't hit the backend on every turn.
+CACHE_TTL = {"models": 300.0, "users": 30.0}
+NEGATIVE_CACHE_TTL = 30.0
+CACHE_SIZE = 1024
+_cache = {"models": OrderedDict(), "users": OrderedDict()}
+
+
+def _store_cached(kind, key, expires_at, data):
+    """Cache `data` for `key`, evicting the least recently used entries over the limit."""
+    cache = _cache[kind]
+    cache[key] = (expires_at, data)
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+async def _get_cached(client, kind, key, url, headers):
+    """Return metadata for `key` from the cache, fetching it on a miss."""
+    now = time.monotonic()
+    entry = _cache[kind].get(key)
+    if entry and entry[0] > now:
+        _cache[kind].move_to_end(key)
+        return entry[1]
+
+    try:
+        res = await client.get(url, headers=headers)
+        if res.status_code == 404:
+            _store_cached(kind, key, now + NEGATIVE_CACHE_TTL, None)
+            return None
+        res.raise_for_status()
+    except Exception:
+        _cache[kind].pop(key, None)
+        raise
+    data = _json_loads(res.content)
+    _store_cached(kind, key, now + CACHE_TTL[kind], data)
+    return data
+
+
+# Models the credits API reported as free: {model name: expires_at}. Turns on them
+# skip token counting and the deduct request until the entry expires.
+_free_models = {}
+
+
+def _remember_free(model_name, is_free):
+    """Record whether the credits API reported `model_name` as free."""
+    if is_free:
+        _free_models[model_name] = time.monotonic() + CACHE_TTL["models"]
+    else:
+        _free_models.pop(model_name, None)
+
 
 class Filter:
-    def _count_tokens_tiktoken(self, text: str, encoding_name: str) -> int:
-        """Counts tokens using a specified tiktoken encoding."""
-        encoding = tiktoken.get_encoding(encoding_name)
-        return len(encoding.encode(text))
+    def _count_tokens_tiktoken(self, texts: list, encoding_name: str) -> int:
+        """Counts tokens in a batch of texts using a specified tiktoken encoding."""
+        total_tokens = 0
+        pieces = []  # Texts (or slices of long texts) that still have to be encoded
+        owners = []  # Cache key each piece's count is stored under, None if uncached
+        queued = set()  # Cache keys of texts already queued for encoding
+        repeats = []  # Keys of texts queued earlier in this batch, counted once encoded
+        for text in texts:
+            if len(text) > HARD_CAP_CHARS:
+                self.estimation_warning = "⚠️ The cost is an estimate."
+                total_tokens += len(text) // 4
+                continue
+
+            key = None
+            if len(text) >= TOKEN_CACHE_MIN_CHARS:
+                # surrogatepass: lone surrogates are valid in JSON message content
+                digest = hashlib.blake2b(
+                    text.encode("utf-8", "surrogatepass"), digest_size=16
+                ).digest()
+                key = (encoding_name, digest)
+                count = _token_counts.get(key)
+                if count is not None:
+                    _token_counts.move_to_end(key)
+                    total_tokens += count
+                    continue
+                if key in queued:
+                    repeats.append(key)
+                    continue
+                queued.add(key)
+
+            for i in range(0, len(text), CHUNK_CHARS):
+                pieces.append(text[i:i + CHUNK_CHARS])
+                owners.append(key)
+
+        if not pieces:
+            return total_tokens
+
+        encoding = _get_encoding(encoding_name)
+        # The batch API encodes on a thread pool; only worth it for larger batches
+        if len(pieces) >= BATCH_MIN_TEXTS:
+            counts = map(len, encoding.encode_ordinary_batch(pieces))
+        else:
+            counts = (len(encoding.encode_ordinary(piece)) for piece in pieces)
+
+        new_counts = {}
+        for key, count in zip(owners, counts):
+            total_tokens += count
+            if key is not None:
+                new_counts[key] = new_counts.get(key, 0) + count
+        total_tokens += sum(new_counts[key] for key in repeats)
+        _token_counts.update(new_counts)
+        while len(_token_counts) > TOKEN_CACHE_SIZE:
+            _token_counts.popitem(last=False)
 
-    def _count_tokens_anthropic_dummy(self, text: str) -> int:
+        return total_tokens
+
+    def _count_tokens_anthropic_dummy(self, texts: list) -> int:
         """
         Example of a dummy counting function for a different library.
         e.g., from anthropic import Anthropic; client = Anthropic(); client.count_tokens(text)
         """
         # Dummy implementation: count words
-        return len(text.split())
+        return sum(len(text.split()) for text in texts)
 
     class Valves(BaseModel):
         show_status: bool = Field(
@@ -59,33 +260,72 @@ class Filter:
         credits_api_host: str = Field(default="147.228.121.27:8000", description="API host and port")
         ssl_verify: bool = Field(default=False, description="Verify SSL certificates")
         api_key: str = Field(default="vY97Yvh6qKywm8xE-ErTGfUofV0t1BiZ36wR3lLNHIY", description="API key for authentication")
+        legacy_server: bool = Field(
+            default=False,
+            description="Look up user and model before charging (for credit admin servers whose /deduct-tokens doesn't report them)",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
         self.estimation_warning = ""
-        # Map of model name patterns to their respective token counting functions.
+        # Map of model name prefixes to their respective token counting functions.
+        # Each function takes a list of texts and returns their total token count.
         self.COUNT_FUNCTIONS = {
-            r"^(gpt-4\.1|4o-mini|o4)": partial(
+            ("gpt-4.1", "4o-mini", "o4"): partial(
                 self._count_tokens_tiktoken, encoding_name="o200k_base"
             ),
-            r"^(claude-.*)": self._count_tokens_anthropic_dummy,
+            ("claude-",): self._count_tokens_anthropic_dummy,
         }
+        # The chosen counter is remembered per model name
+        self._counter_for = lru_cache(maxsize=128)(self._select_counter)
+        self._config_key = None
+        self._config_value = None
+
+    def _config(self):
+        """Return (base URL, headers, JSON headers) for the credits API, rebuilt only when the valves change"""
+        key = (
+            self.valves.credits_api_protocol,
+            self.valves.credits_api_host,
+            self.valves.api_key,
+        )
+        if key != self._config_key:
+            protocol, host, api_key = key
+            headers = {"X-API-Key": api_key} if api_key else {}
+            self._config_value = (
+                f"{protocol}://{host}/api/credits",
+                headers,
+                {**headers, "Content-Type": "application/json"},
+            )
+            self._config_key = key
+        return self._config_value
 
     def _get_user_language(self, body):
         """Extract user language from body metadata"""
-        try:
-            return body.get('metadata', {}).get('variables', {}).get('{{USER_LANGUAGE}}', 'en')
-        except:
-            return 'en'
+        metadata = body.get('metadata')
+        variables = metadata.get('variables') if isinstance(metadata, dict) else None
+        if isinstance(variables, dict):
+            return variables.get('{{USER_LANGUAGE}}') or 'en'
+        return 'en'
+
+    async def _emit_status(self, __event_emitter__, description):
+        """Emit a finished status message if status display is enabled"""
+        if self.valves.show_status and __event_emitter__:
+            await __event_emitter__(
+                {
+                    "type": "status",
+                    "data": {
+                        "description": description,
+                        "done": True,
+                    },
+                }
+            )
 
     def _translate(self, key, lang='en', **kwargs):
         """Get translated string for given key and language"""
         # Get the translation for the specific language, fallback to English
-        translation = TRANSLATIONS.get(lang, TRANSLATIONS['en']).get(key, TRANSLATIONS['en'].get(key, key))
-        
-        # Ensure we have a valid translation string
-        if translation is None:
-            translation = key
+        translation = _FLAT_TRANSLATIONS.get((lang, key)) or _FLAT_TRANSLATIONS.get(('en', key), key)
+        if not kwargs:
+            return translation
         
         # Format the translation with any provided kwargs
         try:
@@ -93,47 +333,63 @@ class Filter:
         except:
             return translation
 
-    def get_token_count(self, text: str, model_name: str) -> int:
+    def _count_tokens_estimate(self, texts: list) -> int:
+        """Counts tokens with cl100k_base for models tiktoken doesn't know."""
+        self.estimation_warning = "⚠️ The cost is an estimate."
+        return self._count_tokens_tiktoken(texts, "cl100k_base")
+
+    def _select_counter(self, model_name: str):
         """
-        Returns the token count for a given text and model.
+        Returns the token counting function for a model name.
         """
         # Check for a matching counting function for special cases
-        for pattern, func in self.COUNT_FUNCTIONS.items():
-            if re.match(pattern, model_name):
-                return func(text)
+        for prefixes, func in self.COUNT_FUNCTIONS.items():
+            if model_name.startswith(prefixes):
+                return func
 
         # If no special mapping, try getting encoding from model name
-        try:
-            encoding = tiktoken.encoding_for_model(model_name)
-            return len(encoding.encode(text))
-        except KeyError:
-            self.estimation_warning = "⚠️ The cost is an estimate."
-            encoding = tiktoken.get_encoding("cl100k_base")
-            return len(encoding.encode(text))
+        encoding = _encoding_for_model(model_name)
+        if encoding is None:
+            return self._count_tokens_estimate
+        return partial(self._count_tokens_tiktoken, encoding_name=encoding.name)
 
-    def count_tokens(self, msg: dict, model_name: str) -> int:
+    def get_token_count(self, text: str, model_name: str) -> int:
+        """
+        Returns the token count for a given text and model.
+        """
+        return self._counter_for(model_name)([text])
+
+    def get_batch_token_count(self, texts: list, model_name: str) -> int:
+        """
+        Returns the total token count for a list of texts and a model.
+        """
+        return self._counter_for(model_name)(texts)
+
+    def iter_texts(self, msg: dict):
+        """Yields the text parts of a message."""
         content = msg.get("content", "")
-        total_tokens = 0
 
         if isinstance(content, list):
             # Handle multi-modal content
             for item in content:
                 if item.get("type") == "text":
-                    text = item.get("text", "")
-                    total_tokens += self.get_token_count(text, model_name)
+                    yield item.get("text", "")
         elif isinstance(content, str):
             # Handle text-only content
-            total_tokens = self.get_token_count(content, model_name)
-        else:
-            # Handle unexpected content types
-            total_tokens = 0
+            yield content
+        # Unexpected content types have no text
 
-        return total_tokens
+    def get_texts(self, msg: dict) -> list:
+        """Returns the text parts of a message."""
+        return list(self.iter_texts(msg))
+
+    def count_tokens(self, msg: dict, model_name: str) -> int:
+        return self.get_batch_token_count(self.get_texts(msg), model_name)
 
     async def outlet(
         self, body, __user__=None, __event_emitter__=None, __event_call__=None
     ):
-        credits_api_base_url = f"{self.valves.credits_api_protocol}://{self.valves.credits_api_host}/api/credits"
+        credits_api_base_url, headers, json_headers = self._config()
         if not __user__:
             return body
 
@@ -148,6 +404,13 @@ class Filter:
         if not messages:
             return body
 
+        # Known free models are never charged, so don't count their tokens
+        if _free_models.get(model_name, 0) > time.monotonic():
+            await self._emit_status(
+                __event_emitter__, self._translate('free_model', user_lang)
+            )
+            return body
+
         # print(body)
 
         # The last message is the completion, the rest are the prompt
@@ -169,11 +432,12 @@ class Filter:
             )
 
         else:
-            # Fallback to manual counting if usage is not available
-            prompt_messages = messages[:-1]
-            prompt_tokens = sum(
-                self.count_tokens(msg, model_name) for msg in prompt_messages
-            )
+            # Fallback to manual counting if usage is not available, encoding all
+            # prompt texts in one batch
+            prompt_texts = [
+                text for msg in messages[:-1] for text in self.iter_texts(msg)
+            ]
+            prompt_tokens = self.get_batch_token_count(prompt_texts, model_name)
             completion_tokens = self.count_tokens(completion_message, model_name)
             cached_tokens = 0  # Not available in manual counting
             reasoning_tokens = 0  # Not available in manual counting
@@ -182,106 +446,86 @@ class Filter:
             else:
                 actor = "manual-count"
 
-        try:
-            # Set up headers with API key
-            headers = {"X-API-Key": self.valves.api_key} if self.valves.api_key else {}
-
-            async with httpx.AsyncClient(verify=self.valves.ssl_verify) as client:
-                # Use optimized endpoints - get only the specific user and model we need
-                user_res = await client.get(
-                    f"{credits_api_base_url}/user/{user_id}", headers=headers
+        client = _get_client(self.valves.ssl_verify)
+
+        if self.valves.legacy_server:
+            # Older credit admin servers don't report user/model lookups from
+            # /deduct-tokens, so check both up front
+            try:
+                # Use optimized endpoints - get only the specific user and model we need,
+                # fetched concurrently so the turn pays one round trip instead of two
+                user_data, model_data = await asyncio.gather(
+                    _get_cached(
+                        client, "users", user_id,
+                        f"{credits_api_base_url}/user/{_path_segment(user_id)}", headers,
+                    ),
+                    _get_cached(
+                        client, "models", model_name,
+                        f"{credits_api_base_url}/model/{_path_segment(model_name)}", headers,
+                    ),
                 )
-                model_res = await client.get(
-                    f"{credits_api_base_url}/model/{model_name}", headers=headers
+            except (httpx.HTTPError, ValueError) as e:
+                await self._emit_status(
+                    __event_emitter__,
+                    self._translate('failed_to_load_metadata', user_lang).format(str(e)),
                 )
-                user_res.raise_for_status()
-                model_res.raise_for_status()
-                user_data = user_res.json()
-                model_data = model_res.json()
-        except Exception as e:
-            if self.valves.show_status and __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {
-                            "description": self._translate('failed_to_load_metadata', user_lang).format(str(e)),
-                            "done": True,
-                        },
-                    }
-                )
-            return body
+                return body
 
-        if not model_data or not user_data:
-            if self.valves.show_status and __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {
-                            "description": self._translate('missing_user_model_data', user_lang),
-                            "done": True,
-                        },
-                    }
+            if not model_data or not user_data:
+                await self._emit_status(
+                    __event_emitter__, self._translate('missing_user_model_data', user_lang)
                 )
-            return body
-
-        # Check if model is free
-        is_free = model_data.get("is_free", False)
-
-        if is_free:
-            # For free models, skip credit deduction
-            if self.valves.show_status and __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {
-                            "description": self._translate('free_model', user_lang),
-                            "done": True,
-                        },
-                    }
+                return body
+
+            # Check if model is free
+            _remember_free(model_name, model_data.get("is_free", False))
+            if model_data.get("is_free", False):
+                # For free models, skip credit deduction
+                await self._emit_status(
+                    __event_emitter__, self._translate('free_model', user_lang)
                 )
-            return body
+                return body
 
-        context_price = float(model_data.get("context_price", 0))
-        generation_price = float(model_data.get("generation_price", 0))
-        credits = float(user_data.get("credits", 0))
+        try:
+            # Use the new optimized deduction endpoint - it also reports whether the
+            # user and model exist and whether the model is free
+            deduction_res = await client.post(
+                f"{credits_api_base_url}/deduct-tokens",
+                content=_json_dumps({
+                    "user_id": user_id,
+                    "model_id": model_name,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "cached_tokens": cached_tokens,
+                    "reasoning_tokens": reasoning_tokens,
+                    "actor": actor,
+                }),
+                headers=json_headers,
+            )
+            deduction_res.raise_for_status()
+            result = _json_loads(deduction_res.content)
+            new_balance = result.get("new_balance", 0)
+            actual_cost = result.get("deducted", 0)
+            full_cost = result.get("cost", 0)
+        except (httpx.HTTPError, ValueError) as e:
+            # Network/HTTP errors and malformed JSON; cancellation and bugs propagate
+            await self._emit_status(
+                __event_emitter__,
+                self._translate('failed_to_deduct', user_lang).format(str(e)),
+            )
+            return body
 
-        cost = prompt_tokens * context_price + completion_tokens * generation_price
+        if not result.get("user_exists", True) or not result.get("model_exists", True):
+            await self._emit_status(
+                __event_emitter__, self._translate('missing_user_model_data', user_lang)
+            )
+            return body
 
-        try:
-            # Set up headers with API key
-            headers = {"X-API-Key": self.valves.api_key} if self.valves.api_key else {}
-
-            async with httpx.AsyncClient(verify=self.valves.ssl_verify) as client:
-                # Use the new optimized deduction endpoint
-                deduction_res = await client.post(
-                    f"{credits_api_base_url}/deduct-tokens",
-                    json={
-                        "user_id": user_id,
-                        "model_id": model_name,
-                        "prompt_tokens": prompt_tokens,
-                        "completion_tokens": completion_tokens,
-                        "cached_tokens": cached_tokens,
-                        "reasoning_tokens": reasoning_tokens,
-                        "actor": actor,
-                    },
-                    headers=headers,
-                )
-                deduction_res.raise_for_status()
-                result = deduction_res.json()
-                new_balance = result.get("new_balance", 0)
-                actual_cost = result.get("deducted", 0)
-                full_cost = result.get("cost", 0)
-        except Exception as e:
-            if self.valves.show_status and __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {
-                            "description": self._translate('failed_to_deduct', user_lang).format(str(e)),
-                            "done": True,
-                        },
-                    }
-                )
+        _remember_free(model_name, result.get("is_free", False))
+        if result.get("is_free", False):
+            await self._emit_status(
+                __event_emitter__, self._translate('free_model', user_lang)
+            )
             return body
 
         if self.valves.show_status and __event_emitter__:
@@ -301,14 +545,6 @@ class Filter:
                 estimate_warning = self._translate('cost_estimate', user_lang)
                 description = estimate_warning + "<br/>" + description
 
-            await __event_emitter__(
-                {
-                    "type": "status",
-                    "data": {
-                        "description": description,
-                        "done": True,
-                    },
-                }
-            )
+            await self._emit_status(__event_emitter__, description)
 
         return body
@@ -2,16 +2,33 @@
 title: Credit management  enough credits
 author: Miloslav Konopík, DDVVY
 version: 1.0
+requirements: orjson, httpx[http2]
 """
 
+import importlib.util
 import os
+import sys
+import asyncio
+import time
+from collections import OrderedDict
+from functools import lru_cache, partial
+from types import MappingProxyType
+from urllib.parse import quote
 from pydantic import BaseModel, Field
 import httpx
 
+# orjson parses the credits API responses several times faster than the standard
+# library; fall back to json where it isn't installed
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 # Translation table for i18n support
 TRANSLATIONS = {
     'cs-CZ': {
         'failed_to_load_data': 'Nepodařilo se načíst data kreditů: {}',
+        'credit_check_timeout': 'Služba kreditů neodpověděla včas – kredity nebyly ověřeny.',
         'user_not_found': 'Data uživatele nenalezena.',
         'model_not_found': 'Model nenalezen v ceníku.',
         'free_model': '🆓 Bezplatný model - kredity neúčtovány.',
@@ -20,6 +37,7 @@ TRANSLATIONS = {
     },
     'en': {  # Fallback language
         'failed_to_load_data': 'Unable to load credit data: {}',
+        'credit_check_timeout': 'The credits service did not respond in time – credits were not checked.',
         'user_not_found': 'User data not found.',
         'model_not_found': 'Model not found in cost list.',
         'free_model': '🆓 Free model - no credits charged.',
@@ -27,9 +45,227 @@ TRANSLATIONS = {
         'insufficient_credits_error': 'You do not have enough credits: {} available, minimum {} required.'
     }
 }
+# Per-language translation tables with missing keys filled in from English, frozen
+# read-only with interned keys
+_RESOLVED_TRANSLATIONS = MappingProxyType({
+    sys.intern(lang): MappingProxyType(
+        {sys.intern(key): text for key, text in {**TRANSLATIONS['en'], **table}.items()}
+    )
+    for lang, table in TRANSLATIONS.items()
+})
+
+@lru_cache(maxsize=1024)
+def _path_segment(value):
+    """Percent-encode an ID for use as a single URL path segment."""
+    return quote(str(value), safe="")
+
+
+# Shared HTTP clients, one per SSL verification setting, reused across requests
+# so connections to the credits API stay alive between chat turns. Over HTTPS they
+# negotiate HTTP/2 when the h2 package is installed, multiplexing concurrent
+# requests on one connection.
+_CLIENTS = {}
+# The credit check runs before every prompt, so a slow credits API must not hold
+# the prompt up for long
+REQUEST_TIMEOUT = httpx.Timeout(connect=1.0, read=2.0, write=1.0, pool=1.0)
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+def _get_client(verify):
+    """Return the pooled AsyncClient for the given SSL verification setting."""
+    client = _CLIENTS.get(verify)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            verify=verify,
+            http2=_HTTP2,
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+            timeout=REQUEST_TIMEOUT,
+        )
+        _CLIENTS[verify] = client
+    return client
+
+
+# Model pricing changes rarely, so it is cached for a few minutes:
+# {model name: (expires_at, data)}, least recently used first. User balances change with every charge but
+# are stable within a burst of messages, so they are kept for a couple of seconds.
+# Unknown models and users (404) are remembered briefly as None so a bad ID
+# doesn't hit the backend on every turn.
+MODEL_CACHE_TTL = 300.0
+USER_CACHE_TTL = 2.0
+NEGATIVE_CACHE_TTL = 30.0
+CACHE_SIZE = 1024
+_model_cache = OrderedDict()
+_user_cache = OrderedDict()
+
+
+def _store_cached(cache, key, expires_at, data):
+    """Cache `data` for `key`, evicting the least recently used entries over the limit."""
+    cache[key] = (expires_at, data)
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+# Lookups currently in flight: {(kind, id): task}. Concurrent misses for the same
+# ID wait for the one request instead of each fetching it.
+_inflight = {}
+
+
+async def _singleflight(key, fetch):
+    """Await `fetch()`, sharing one call among concurrent callers with the same key."""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded so one caller being cancelled doesn't cancel the fetch for the rest
+    return await asyncio.shield(task)
+
+
+async def _get_model(client, model_name, url, headers):
+    """Return pricing for `model_name` from the cache, fetching it on a miss."""
+    entry = _model_cache.get(model_name)
+    if entry and entry[0] > time.monotonic():
+        _model_cache.move_to_end(model_name)
+        return entry[1]
+    return await _singleflight(
+        ("model", model_name), partial(_fetch_model, client, model_name, url, headers)
+    )
+
+
+async def _fetch_model(client, model_name, url, headers):
+    """Fetch pricing for `model_name` and store it in the cache."""
+    now = time.monotonic()
+    try:
+        res = await client.get(url, headers=headers)
+        if res.status_code == 404:
+            _store_cached(_model_cache, model_name, now + NEGATIVE_CACHE_TTL, None)
+            return None
+        res.raise_for_status()
+    except Exception:
+        _model_cache.pop(model_name, None)
+        raise
+    data = _json_loads(res.content)
+    _store_cached(_model_cache, model_name, now + MODEL_CACHE_TTL, data)
+    return data
+
+
+async def _get_user(client, user_id, url, headers):
+    """Return credit data for `user_id`, or None if the user is not known."""
+    entry = _user_cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        _user_cache.move_to_end(user_id)
+        return entry[1]
+    return await _singleflight(
+        ("user", user_id), partial(_fetch_user, client, user_id, url, headers)
+    )
+
+
+async def _fetch_user(client, user_id, url, headers):
+    """Fetch credit data for `user_id` and store it in the cache."""
+    now = time.monotonic()
+    try:
+        res = await client.get(url, headers=headers)
+        if res.status_code == 404:
+            _store_cached(_user_cache, user_id, now + NEGATIVE_CACHE_TTL, None)
+            return None
+        res.raise_for_status()
+    except Exception:
+        _user_cache.pop(user_id, None)
+        raise
+    data = _json_loads(res.content)
+    _store_cached(_user_cache, user_id, now + USER_CACHE_TTL, data)
+    return data
+
+
+async def _precheck(client, user_id, model_name, url, headers):
+    """Return (user data, model pricing), fetching both in one request unless cached."""
+    now = time.monotonic()
+    user_entry = _user_cache.get(user_id)
+    model_entry = _model_cache.get(model_name)
+    if user_entry and user_entry[0] > now and model_entry and model_entry[0] > now:
+        _user_cache.move_to_end(user_id)
+        _model_cache.move_to_end(model_name)
+        return user_entry[1], model_entry[1]
+    return await _singleflight(
+        ("precheck", user_id, model_name),
+        partial(_fetch_precheck, client, user_id, model_name, url, headers),
+    )
+
+
+async def _fetch_precheck(client, user_id, model_name, url, headers):
+    """Fetch user data and model pricing from /precheck and store both in the caches."""
+    now = time.monotonic()
+    res = await client.get(
+        url, params={"user_id": user_id, "model_id": model_name}, headers=headers
+    )
+    res.raise_for_status()
+    data = _json_loads(res.content)
+    user_data = data.get("user")
+    model_data = data.get("model")
+    _store_cached(
+        _user_cache, user_id,
+        now + (USER_CACHE_TTL if user_data else NEGATIVE_CACHE_TTL), user_data,
+    )
+    _store_cached(
+        _model_cache, model_name,
+        now + (MODEL_CACHE_TTL if model_data else NEGATIVE_CACHE_TTL), model_data,
+    )
+    return user_data, model_data
+
 
+# Fire-and-forget tasks, referenced here so they aren't garbage collected while running
+_background_tasks = set()
 
 
+def _run_in_background(coro):
+    """Schedule `coro` without awaiting it."""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+# IDs of models each credits API lists as free, keyed by the list's URL so filters
+# pointed at different servers don't share one list. While a list is fresh, prompts
+# on these models skip the credit lookup; it is reloaded in the background when stale.
+FREE_MODELS_TTL = 300.0
+_free_models = {}
+
+
+async def _refresh_free_models(client, url, headers):
+    """Reload the free model list at `url`, leaving it stale if the request fails."""
+    try:
+        res = await client.get(url, headers=headers)
+        res.raise_for_status()
+        data = _json_loads(res.content)
+    except (httpx.HTTPError, ValueError):
+        return
+    models = data.get("models") if isinstance(data, dict) else None
+    if not isinstance(models, list):
+        return
+    entry = _free_models[url]
+    entry["ids"] = frozenset(models)
+    entry["expires"] = time.monotonic() + FREE_MODELS_TTL
+
+
+def _is_listed_free(client, model_name, url, headers):
+    """Return True if `model_name` is on the fresh free model list, refreshing a stale list."""
+    now = time.monotonic()
+    entry = _free_models.get(url)
+    if entry is None:
+        entry = _free_models[url] = {"expires": 0.0, "retry": 0.0, "ids": frozenset()}
+    if entry["expires"] > now:
+        return model_name in entry["ids"]
+    if entry["retry"] <= now:
+        entry["retry"] = now + NEGATIVE_CACHE_TTL
+        _run_in_background(_refresh_free_models(client, url, headers))
+    return False
+
+
+# Last status shown to each user: {user id: (shown_at, description)}. The same
+# status repeated within a few seconds is not sent again.
+STATUS_REPEAT_WINDOW = 3.0
+_last_status = {}
+
 
 # If not available in your project, define your own exception:
 class FilterException(Exception):
@@ -51,92 +287,139 @@ class Filter:
         credits_api_host: str = Field(default="localhost:8000", description="API host and port")
         ssl_verify: bool = Field(default=False, description="Verify SSL certificates")
         api_key: str = Field(default="", description="API key for authentication")
+        legacy_server: bool = Field(
+            default=False,
+            description="Look up user and model separately (for credit admin servers without /precheck)",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
+        self._config_key = None
+        self._config_value = None
+
+    def _config(self):
+        """Return (base URL, headers) for the credits API, rebuilt only when the valves change"""
+        key = (
+            self.valves.credits_api_protocol,
+            self.valves.credits_api_host,
+            self.valves.api_key,
+        )
+        if key != self._config_key:
+            protocol, host, api_key = key
+            self._config_value = (
+                f"{protocol}://{host}/api/credits",
+                {"X-API-Key": api_key} if api_key else {},
+            )
+            self._config_key = key
+        return self._config_value
 
     def _get_user_language(self, body):
         """Extract user language from body metadata"""
-        try:
-            return body.get('metadata', {}).get('variables', {}).get('{{USER_LANGUAGE}}', 'en')
-        except:
-            return 'en'
+        # metadata and variables can be present but null, so check before descending
+        metadata = body.get('metadata')
+        variables = metadata.get('variables') if isinstance(metadata, dict) else None
+        if isinstance(variables, dict):
+            return variables.get('{{USER_LANGUAGE}}') or 'en'
+        return 'en'
+
+    async def _emit_status(self, __event_emitter__, user_id, description):
+        """Emit a finished status message if status display is enabled and the user
+        wasn't just shown the same one"""
+        if self.valves.show_status and __event_emitter__:
+            now = time.monotonic()
+            last = _last_status.get(user_id)
+            if last and last[1] == description and now - last[0] < STATUS_REPEAT_WINDOW:
+                return
+            # Re-inserted so entries stay oldest first, and expired ones are dropped
+            # from the front; only users shown a status in the last window remain
+            _last_status.pop(user_id, None)
+            _last_status[user_id] = (now, description)
+            while True:
+                oldest = next(iter(_last_status))
+                if now - _last_status[oldest][0] < STATUS_REPEAT_WINDOW:
+                    break
+                del _last_status[oldest]
+            await __event_emitter__(
+                {
+                    "type": "status",
+                    "data": {
+                        "description": description,
+                        "done": True,
+                    },
+                }
+            )
 
     def _translate(self, key, lang='en', **kwargs):
         """Get translated string for given key and language"""
         # Get the translation for the specific language, fallback to English
-        translation = TRANSLATIONS.get(lang, TRANSLATIONS['en']).get(key, TRANSLATIONS['en'].get(key, key))
+        table = _RESOLVED_TRANSLATIONS.get(lang) or _RESOLVED_TRANSLATIONS['en']
+        translation = table.get(key, key)
         
-        # Ensure we have a valid translation string
-        if translation is None:
-            translation = key
-        
-        # Format the translation with any provided kwargs
-        try:
-            return translation.format(**kwargs)
-        except:
-            return translation
+        # Format the translation with any provided kwargs; messages with positional
+        # placeholders are formatted by the caller
+        return translation.format_map(kwargs) if kwargs else translation
 
     def format_credit_amount(self, amount):
         """Format credit amount to avoid scientific notation and excessive precision"""
         if amount == 0:
             return "0"
         
-        # Convert to decimal string to avoid scientific notation
-        decimal_str = f"{amount:.10f}"
-        
-        # Remove trailing zeros and decimal point if not needed
-        if '.' in decimal_str:
-            decimal_str = decimal_str.rstrip('0').rstrip('.')
-        
-        # If the result is empty (very small number), show minimum precision
-        if not decimal_str or decimal_str == '0.':
-            return f"{amount:.8f}".rstrip('0').rstrip('.')
-        
-        return decimal_str
+        # Fixed-point with 10 decimals avoids scientific notation and always has a
+        # decimal point, so trailing zeros and the point can be stripped directly
+        return f"{amount:.10f}".rstrip('0').rstrip('.')
 
     async def inlet(
         self, body, __user__=None, __event_emitter__=None, __event_call__=None
     ):
-        credits_api_base_url = f"{self.valves.credits_api_protocol}://{self.valves.credits_api_host}/api/credits"
+        credits_api_base_url, headers = self._config()
         user_id = __user__.get("id")
         model_name = body.get("model")
-        prompt_text = body["messages"][-1]["content"]
-        prompt_tokens = body.get("prompt_tokens") or max(len(prompt_text) // 4, 1)
         
         # Get user language for translations
         user_lang = self._get_user_language(body)
 
+        client = _get_client(self.valves.ssl_verify)
+        if not self.valves.legacy_server and _is_listed_free(
+            client, model_name, f"{credits_api_base_url}/free-models", headers
+        ):
+            # Free models need no credit check
+            await self._emit_status(__event_emitter__, user_id, self._translate('free_model', user_lang))
+            return body
+
         try:
-            # Set up headers with API key
-            headers = {"X-API-Key": self.valves.api_key} if self.valves.api_key else {}
-            
-            async with httpx.AsyncClient(verify=self.valves.ssl_verify) as client:
-                # Use optimized endpoints - get only specific user and model
-                user_res = await client.get(
-                    f"{credits_api_base_url}/user/{user_id}",
-                    headers=headers
+            if self.valves.legacy_server:
+                # Use optimized endpoints - get only specific user and model, concurrently;
+                # on a model cache hit only the user is fetched
+                user_data, model_data = await asyncio.gather(
+                    _get_user(
+                        client, user_id,
+                        f"{credits_api_base_url}/user/{_path_segment(user_id)}", headers,
+                    ),
+                    _get_model(
+                        client, model_name,
+                        f"{credits_api_base_url}/model/{_path_segment(model_name)}", headers,
+                    ),
                 )
-                model_res = await client.get(
-                    f"{credits_api_base_url}/model/{model_name}",
-                    headers=headers
+            else:
+                # Get user and model together in a single request
+                user_data, model_data = await _precheck(
+                    client, user_id, model_name,
+                    f"{credits_api_base_url}/precheck", headers,
                 )
-                user_res.raise_for_status()
-                model_res.raise_for_status()
-                user_data = user_res.json()
-                model_data = model_res.json()
-        except Exception as e:
+        except httpx.TimeoutException:
+            body["messages"][-1]["content"] += f"\n\n{self._translate('credit_check_timeout', user_lang)}"
+            return body
+        except (httpx.HTTPError, ValueError) as e:
+            # Network/HTTP errors and malformed JSON; cancellation and bugs propagate
             body["messages"][-1][
                 "content"
             ] += f"\n\n{self._translate('failed_to_load_data', user_lang).format(str(e))}"
             return body
 
-        user_data = user_data
         if not user_data:
             body["messages"][-1]["content"] += f"\n\n{self._translate('user_not_found', user_lang)}"
             return body
 
-        model_data = model_data
         if not model_data:
             body["messages"][-1]["content"] += f"\n\n{self._translate('model_not_found', user_lang)}"
             return body
@@ -144,33 +427,23 @@ class Filter:
         # Check if model is free - if so, allow the request without credit check
         is_free = model_data.get("is_free", False)
         if is_free:
-            if self.valves.show_status and __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {
-                            "description": self._translate('free_model', user_lang),
-                            "done": True,
-                        },
-                    }
-                )
+            await self._emit_status(__event_emitter__, user_id, self._translate('free_model', user_lang))
             return body
 
+        # Use the caller's token count if given (even 0), otherwise estimate ~4 chars/token
+        prompt_tokens = body.get("prompt_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = max(len(body["messages"][-1]["content"]) // 4, 1)
+
         context_price = model_data.get("context_price", 0)
         cost = prompt_tokens * context_price
         credits = user_data.get("credits", 0)
 
         if credits < cost:
-            if self.valves.show_status and __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {
-                            "description": self._translate('insufficient_prompt_blocked', user_lang),
-                            "done": True,
-                        },
-                    }
-                )
+            # Deliver the status while the exception unwinds instead of before it
+            _run_in_background(self._emit_status(
+                __event_emitter__, user_id, self._translate('insufficient_prompt_blocked', user_lang)
+            ))
 
             raise FilterException(
                 self._translate('insufficient_credits_error', user_lang).format(
@@ -2,37 +2,150 @@
 title: Credit management Models
 author: Miloslav Konopík, DDVVY
 version: 1.0
+requirements: orjson, httpx[http2]
 """
 
+import asyncio
+import importlib.util
+import math
 import os
+import sys
+import time
+from collections import OrderedDict
+from functools import lru_cache, partial
+from types import MappingProxyType
+from urllib.parse import quote
 from pydantic import BaseModel, Field
 import httpx
 
+# orjson parses the credits API responses several times faster than the standard
+# library; fall back to json where it isn't installed
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 # Translation table for i18n support
 TRANSLATIONS = {
     'cs-CZ': {
-        'failed_to_load_pricing': 'Nepodařilo se načíst ceník modelu: {}',
+        'failed_to_load_pricing': 'Nepodařilo se načíst ceník modelu: {err}',
         'model_not_found_pricing': 'Model nenalezen v ceníku.',
-        'model_pricing_title': '📊 Ceník modelu **{}**:',
+        'model_pricing_title': '📊 Ceník modelu **{model}**:',
         'free_model_pricing': '🆓 **BEZPLATNÝ MODEL** - Žádné kredity nejsou vyžadovány',
         'prompt_price': '• Prompt (vstup): {} kreditů/token',
         'completion_price': '• Dokončení (výstup): {} kreditů/token',
-        'prompt_price_1m': '• Prompt (vstup, 1M tokenů): {} kreditů',
-        'completion_price_1m': '• Dokončení (výstup, 1M tokenů): {} kreditů'
+        'prompt_price_1m': '• Prompt (vstup, 1M tokenů): {prompt} kreditů',
+        'completion_price_1m': '• Dokončení (výstup, 1M tokenů): {completion} kreditů'
     },
     'en': {  # Fallback language
-        'failed_to_load_pricing': ' Failed to load model pricing: {}',
+        'failed_to_load_pricing': ' Failed to load model pricing: {err}',
         'model_not_found_pricing': ' Model not found in pricing list.',
-        'model_pricing_title': '📊 Model **{}** pricing:',
+        'model_pricing_title': '📊 Model **{model}** pricing:',
         'free_model_pricing': '🆓 **FREE MODEL** - No credits required',
         'prompt_price': '• Prompt (input): {} credits/token',
         'completion_price': '• Completion (output): {} credits/token',
-        'prompt_price_1m': '• Prompt (input, 1M tokens): {} credits',
-        'completion_price_1m': '• Completion (output, 1M tokens): {} credits'
+        'prompt_price_1m': '• Prompt (input, 1M tokens): {prompt} credits',
+        'completion_price_1m': '• Completion (output, 1M tokens): {completion} credits'
     }
 }
+# Flat (language, key) -> string view of TRANSLATIONS for single-lookup translation,
+# frozen read-only with interned keys
+_FLAT_TRANSLATIONS = MappingProxyType({
+    (sys.intern(lang), sys.intern(key)): text
+    for lang, table in TRANSLATIONS.items()
+    for key, text in table.items()
+})
+
+
+def _pricing_templates(table):
+    """Combine a language's pricing lines into whole templates for free and paid models."""
+    table = {**TRANSLATIONS['en'], **table}
+    title = "\n\n" + table['model_pricing_title'] + "\n"
+    return {
+        "free": title + table['free_model_pricing'],
+        "paid": title + table['prompt_price_1m'] + "\n" + table['completion_price_1m'],
+    }
+
+
+# Pricing output per language, rendered with a single format call:
+# {lang: {"free" | "paid": template}}
+_PRICING_TEMPLATES = MappingProxyType({
+    sys.intern(lang): MappingProxyType(_pricing_templates(table))
+    for lang, table in TRANSLATIONS.items()
+})
+
+@lru_cache(maxsize=1024)
+def _path_segment(value):
+    """Percent-encode an ID for use as a single URL path segment."""
+    return quote(str(value), safe="")
+
+
+# Shared HTTP clients, one per SSL verification setting, reused across requests
+# so connections to the credits API stay alive between actions. Over HTTPS they
+# negotiate HTTP/2 when the h2 package is installed.
+_CLIENTS = {}
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+def _get_client(verify):
+    """Return the pooled AsyncClient for the given SSL verification setting."""
+    client = _CLIENTS.get(verify)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            verify=verify,
+            http2=_HTTP2,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            timeout=httpx.Timeout(5.0, connect=2.0),
+        )
+        _CLIENTS[verify] = client
+    return client
+
+
+# Model pricing changes rarely, but this action shows the current price on
+# demand, so it is cached only briefly. Keyed by request URL, so changing the
+# credits API host in the valves doesn't serve the old server's prices:
+# {url: (expires_at, data)}, least recently used first
+MODEL_CACHE_TTL = 60.0
+MODEL_CACHE_MAX_SIZE = 256
+_model_cache = OrderedDict()
+
+# Pricing fetches in progress, so concurrent misses share one request: {url: task}
+_inflight = {}
 
 
+def _fetch_done(url, task):
+    """Forget a finished fetch, retrieving its exception so a failure no caller
+    awaited isn't logged as never retrieved."""
+    _inflight.pop(url, None)
+    if not task.cancelled():
+        task.exception()
+
+
+async def _get_model(client, url, headers):
+    """Return the pricing at `url` from the cache, fetching it on a miss."""
+    entry = _model_cache.get(url)
+    if entry and entry[0] > time.monotonic():
+        _model_cache.move_to_end(url)
+        return entry[1]
+    task = _inflight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_model(client, url, headers))
+        _inflight[url] = task
+        task.add_done_callback(partial(_fetch_done, url))
+    # Shielded so one caller being cancelled doesn't cancel the fetch for the rest
+    return await asyncio.shield(task)
+
+
+async def _fetch_model(client, url, headers):
+    """Fetch the pricing at `url` and store it in the cache."""
+    res = await client.get(url, headers=headers)
+    res.raise_for_status()
+    data = _json_loads(res.content)
+    _model_cache[url] = (time.monotonic() + MODEL_CACHE_TTL, data)
+    _model_cache.move_to_end(url)
+    if len(_model_cache) > MODEL_CACHE_MAX_SIZE:
+        _model_cache.popitem(last=False)
+    return data
 
 
 class Action:
@@ -47,87 +160,101 @@ class Action:
 
     def __init__(self):
         self.valves = self.Valves()
+        self._config_key = None
+        self._config_value = None
+
+    def _config(self):
+        """Return (base URL, headers) for the credits API, rebuilt only when the valves change"""
+        key = (
+            self.valves.credits_api_protocol,
+            self.valves.credits_api_host,
+            self.valves.api_key,
+        )
+        if key != self._config_key:
+            protocol, host, api_key = key
+            self._config_value = (
+                f"{protocol}://{host}/api/credits",
+                {"X-API-Key": api_key} if api_key else {},
+            )
+            self._config_key = key
+        return self._config_value
 
     def _get_user_language(self, body):
         """Extract user language from body metadata"""
         try:
-            return body.get('metadata', {}).get('variables', {}).get('{{USER_LANGUAGE}}', 'en')
-        except:
+            return body['metadata']['variables']['{{USER_LANGUAGE}}'] or 'en'
+        except (KeyError, TypeError):
+            # Missing, or metadata or variables present but null
             return 'en'
 
-    def _translate(self, key, lang='en', **kwargs):
+    def _translate(self, key, lang='en', *args, **kwargs):
         """Get translated string for given key and language"""
         # Get the translation for the specific language, fallback to English
-        translation = TRANSLATIONS.get(lang, TRANSLATIONS['en']).get(key, TRANSLATIONS['en'].get(key, key))
-        
-        # Ensure we have a valid translation string
-        if translation is None:
-            translation = key
+        translation = _FLAT_TRANSLATIONS.get((lang, key)) or _FLAT_TRANSLATIONS.get(('en', key), key)
         
-        # Format the translation with any provided kwargs
-        try:
-            return translation.format(**kwargs)
-        except:
-            return translation
+        # Format the translation with any provided arguments
+        return translation.format(*args, **kwargs) if args or kwargs else translation
 
     def _format_credits(self, value):
         """Format credit values with commas and trim unnecessary decimals."""
-        try:
-            s = f"{value:,.6f}"
-            s = s.rstrip('0').rstrip('.')
-            return s
-        except:
+        if not math.isfinite(value):
+            # Infinity/NaN from the stdlib json fallback, or a price overflowing at 1M tokens
             return str(value)
+        if value == int(value):
+            # Whole amounts, the usual case for per-1M-token prices
+            return f"{int(value):,}"
+        # Always has six decimals, so at most one trailing '.' is left to drop
+        return f"{value:,.6f}".rstrip('0').removesuffix('.')
 
     async def action(
         self, body, __user__=None, __event_emitter__=None, __event_call__=None
     ):
-        credits_api_base_url = f"{self.valves.credits_api_protocol}://{self.valves.credits_api_host}/api/credits"
+        credits_api_base_url, headers = self._config()
         model_name = body.get("model", "")
+        last_message = body["messages"][-1]
         
         # Get user language for translations
         user_lang = self._get_user_language(body)
 
+        if not model_name:
+            # No model to look up
+            last_message["content"] += f"\n\n{self._translate('model_not_found_pricing', user_lang)}"
+            return body
+
         try:
-            # Set up headers with API key
-            headers = {"X-API-Key": self.valves.api_key} if self.valves.api_key else {}
-            
-            async with httpx.AsyncClient(verify=self.valves.ssl_verify) as client:
-                # Use optimized endpoint for specific model
-                res = await client.get(
-                    f"{credits_api_base_url}/model/{model_name}",
-                    headers=headers
-                )
-                res.raise_for_status()
-                model_data = res.json()
-        except Exception as e:
-            body["messages"][-1][
-                "content"
-            ] += f"\n\n{self._translate('failed_to_load_pricing', user_lang).format(str(e))}"
+            # Use optimized endpoint for specific model
+            model_data = await _get_model(
+                _get_client(self.valves.ssl_verify),
+                f"{credits_api_base_url}/model/{_path_segment(model_name)}",
+                headers,
+            )
+        except (httpx.HTTPError, ValueError) as e:
+            # Network/HTTP errors and malformed JSON; cancellation and bugs propagate
+            last_message["content"] += f"\n\n{self._translate('failed_to_load_pricing', user_lang, err=str(e))}"
             return body
 
         if not model_data:
-            body["messages"][-1]["content"] += f"\n\n{self._translate('model_not_found_pricing', user_lang)}"
+            last_message["content"] += f"\n\n{self._translate('model_not_found_pricing', user_lang)}"
             return body
 
         context_price = model_data.get("context_price", 0)
         generation_price = model_data.get("generation_price", 0)
         is_free = model_data.get("is_free", False)
 
+        templates = _PRICING_TEMPLATES.get(user_lang) or _PRICING_TEMPLATES['en']
         if is_free:
-            body["messages"][-1]["content"] += (
-                f"\n\n{self._translate('model_pricing_title', user_lang).format(model_name)}\n"
-                f"{self._translate('free_model_pricing', user_lang)}"
-            )
+            last_message["content"] += templates["free"].format(model=model_name)
         else:
-            # Multiply per-token prices by 1,000,000 and format
-            context_price_1m = context_price * 1_000_000
-            generation_price_1m = generation_price * 1_000_000
-
-            body["messages"][-1]["content"] += (
-                f"\n\n{self._translate('model_pricing_title', user_lang).format(model_name)}\n"
-                f"{self._translate('prompt_price_1m', user_lang).format(self._format_credits(context_price_1m))}\n"
-                f"{self._translate('completion_price_1m', user_lang).format(self._format_credits(generation_price_1m))}"
+            # Multiply per-token prices by 1,000,000 and format; rounding to the 6
+            # displayed decimals absorbs float noise (0.000003 * 1e6 = 3.0000000000000004)
+            # so whole prices take the integer path in _format_credits
+            context_price_1m = round(context_price * 1_000_000, 6)
+            generation_price_1m = round(generation_price * 1_000_000, 6)
+
+            last_message["content"] += templates["paid"].format(
+                model=model_name,
+                prompt=self._format_credits(context_price_1m),
+                completion=self._format_credits(generation_price_1m),
             )
 
         return body